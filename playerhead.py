@@ -29,89 +29,142 @@ import sys
 
 from PIL import Image
 import base64
-from docopt import docopt
-import io
 import json
+import numpy
 import os
 import pathlib
-import re
 import requests
 import shutil
-import struct
-import subprocess
-import sys
+import string
 import time
-import traceback
 import uuid
 
+_SESSION = requests.Session()
+_SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+_CACHE_DIR = pathlib.Path(os.environ.get('XDG_CACHE_HOME', pathlib.Path.home() / '.cache')) / 'playerhead'
+_PROFILE_CACHE_TTL = 3600 # seconds before a cached profile is considered stale
+
+_DEFAULT_SKIN_DIR = pathlib.Path(__file__).resolve().parent # steve.png and alex.png ship alongside the module
+_DEFAULT_SKINS = {}
+
+def _default_skin(model):
+    if model not in _DEFAULT_SKINS:
+        img = Image.open(str(_DEFAULT_SKIN_DIR / '{}.png'.format(model))).convert('RGBA')
+        img.load() # decode the pixels once so returning copies is a plain memcpy
+        _DEFAULT_SKINS[model] = img
+    return _DEFAULT_SKINS[model].copy()
+
+def _write_cache(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('{}.{}.tmp'.format(path.name, uuid.uuid4().hex))
+    with tmp_path.open('wb') as tmp_file:
+        if isinstance(data, bytes):
+            tmp_file.write(data)
+        else:
+            shutil.copyfileobj(data, tmp_file)
+    os.replace(str(tmp_path), str(path))
+
+_NICK_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+
+def bulk_resolve(names, error_log=None):
+    if error_log is None:
+        error_log = sys.stderr
+    names = [name for name in names if check_nick(name)] # the API rejects the whole batch if any name is invalid
+    profile_ids = {}
+    for i in range(0, len(names), 10): # the API accepts at most 10 names per call
+        response = retry_request('https://api.mojang.com/profiles/minecraft', error_log=error_log, method='post', json=names[i:i + 10])
+        for profile in response.json():
+            profile_ids[profile['name'].lower()] = uuid.UUID(profile['id'])
+    return profile_ids
+
 def check_nick(player):
-    return bool(re.match('[A-Za-z0-9_]{1,16}$', player))
+    return 1 <= len(player) <= 16 and not set(player) - _NICK_CHARS
 
-def head(player=None, *, player_skin=None, hat=True, profile_id=None, error_log=None):
+def head(player=None, *, player_skin=None, hat=True, profile_id=None, error_log=None, size=None):
     if error_log is None:
         error_log = sys.stderr
     if player_skin is None:
         player_skin, _ = skin(player, profile_id=profile_id, error_log=error_log)
     with player_skin:
+        base = player_skin.crop((8, 8, 16, 16))
         if hat:
-            return Image.alpha_composite(player_skin.crop((8, 8, 16, 16)), player_skin.crop((40, 8, 48, 16)))
-        return player_skin.crop((8, 8, 16, 16))
+            hat_layer = player_skin.crop((40, 8, 48, 16))
+            if hat_layer.getextrema()[3][1] > 0: # skip the blend if the hat layer is fully transparent
+                if size is not None and size[0] * size[1] < 64: # shrink first so the blend touches fewer pixels
+                    return Image.alpha_composite(base.resize(size, Image.NEAREST), hat_layer.resize(size, Image.NEAREST))
+                base = Image.alpha_composite(base, hat_layer)
+        if size is not None and base.size != size:
+            base = base.resize(size, Image.NEAREST)
+        return base
 
 def body(player=None, *, player_skin=None, model=None, hat=True, profile_id=None, error_log=None):
     if error_log is None:
         error_log = sys.stderr
     if player_skin is None or model is None:
         player_skin, model = skin(player, profile_id=profile_id, error_log=error_log)
-    result = Image.new('RGBA', (16, 32))
-    result.paste(player_skin.crop((8, 8, 16, 16)), (4, 0)) # head
-    result.paste(player_skin.crop((20, 20, 28, 32)), (4, 8)) # body
-    result.paste(player_skin.crop((4, 20, 8, 32)), (4, 20)) # right leg
-    result.paste(player_skin.crop((44, 20, 47 if model == 'alex' else 48, 32)), (1 if model == 'alex' else 0, 8)) # right arm
-    if player_skin.size[1] == 32: # old-style skin
-        result.paste(player_skin.crop((4, 20, 8, 32)).transpose(Image.FLIP_LEFT_RIGHT), (8, 20)) # left leg
-        result.paste(player_skin.crop((44, 20, 47 if model == 'alex' else 48, 32)).transpose(Image.FLIP_LEFT_RIGHT), (12, 8)) # left arm
-    else: # new-style skin
-        result.paste(player_skin.crop((20, 52, 24, 64)), (8, 20)) # left leg
-        result.paste(player_skin.crop((36, 52, 39 if model == 'alex' else 40, 64)), (12, 8)) # left arm
     with player_skin:
-        if hat:
-            hat_layer = Image.new('RGBA', (16, 32))
-            hat_layer.paste(player_skin.crop((40, 8, 48, 16)), (4, 0)) # hat
-            if player_skin.size[1] == 64: # new-style skin
-                hat_layer.paste(player_skin.crop((20, 36, 28, 48)), (4, 8)) # jacket
-                hat_layer.paste(player_skin.crop((4, 36, 8, 48)), (4, 20)) # right pants leg
-                hat_layer.paste(player_skin.crop((44, 36, 47 if model == 'alex' else 48, 48)), (1 if model == 'alex' else 0, 8)) # right sleeve
-                hat_layer.paste(player_skin.crop((4, 52, 8, 64)), (8, 20)) # left pants leg
-                hat_layer.paste(player_skin.crop((52, 52, 55 if model == 'alex' else 56, 64)), (12, 8)) # left sleeve
-            return Image.alpha_composite(result, hat_layer)
-        return result
-
-def java_uuid_hash_code(uuid):
-    leastSigBits, mostSigBits = struct.unpack('>QQ', uuid.bytes)
-    l1 = leastSigBits & 0xFFFFFFFF
-    l2 = (leastSigBits & 0xFFFFFFFF00000000) >> 32
-    m1 = mostSigBits & 0xFFFFFFFF
-    m2 = (mostSigBits & 0xFFFFFFFF00000000) >> 32
-    return (l1 ^ l2) ^ (m1 ^ m2)
-
-def retry_request(url, error_log=None, *args, **kwargs):
+        skin_np = numpy.ascontiguousarray(player_skin.convert('RGBA'))
+    result, hat_layer = _compose_body(skin_np, model == 'alex', skin_np.shape[0] == 64, hat)
+    if not hat:
+        return Image.fromarray(result)
+    return Image.alpha_composite(Image.fromarray(result), Image.fromarray(hat_layer))
+
+def _compose_body(skin_np, alex, new_style, hat):
+    arm_width = 3 if alex else 4
+    arm_x = 1 if alex else 0
+    right_leg = skin_np[20:32, 4:8]
+    right_arm = skin_np[20:32, 44:44 + arm_width]
+    result = numpy.zeros((32, 16, 4), numpy.uint8)
+    result[0:8, 4:12] = skin_np[8:16, 8:16] # head
+    result[8:20, 4:12] = skin_np[20:32, 20:28] # body
+    result[20:32, 4:8] = right_leg
+    result[8:20, arm_x:arm_x + arm_width] = right_arm
+    if new_style:
+        result[20:32, 8:12] = skin_np[52:64, 20:24] # left leg
+        result[8:20, 12:12 + arm_width] = skin_np[52:64, 36:36 + arm_width] # left arm
+    else: # old-style skin, mirror the right limbs
+        result[20:32, 8:12] = right_leg[:, ::-1] # left leg
+        result[8:20, 12:12 + arm_width] = right_arm[:, ::-1] # left arm
+    hat_layer = numpy.zeros((32, 16, 4), numpy.uint8)
+    if hat:
+        hat_layer[0:8, 4:12] = skin_np[8:16, 40:48] # hat
+        if new_style:
+            hat_layer[8:20, 4:12] = skin_np[36:48, 20:28] # jacket
+            hat_layer[20:32, 4:8] = skin_np[36:48, 4:8] # right pants leg
+            hat_layer[8:20, arm_x:arm_x + arm_width] = skin_np[36:48, 44:44 + arm_width] # right sleeve
+            hat_layer[20:32, 8:12] = skin_np[52:64, 4:8] # left pants leg
+            hat_layer[8:20, 12:12 + arm_width] = skin_np[52:64, 52:52 + arm_width] # left sleeve
+    return result, hat_layer
+
+try:
+    import numba
+except ImportError:
+    pass # Numba is optional, plain NumPy slice copies are fast enough for single-player runs
+else:
+    _compose_body = numba.njit(cache=True)(_compose_body)
+
+def java_uuid_hash_code(u):
+    # XOR of the four 32-bit quarters of the 128-bit value, like Java's UUID.hashCode()
+    n = u.int
+    return ((n ^ (n >> 32)) ^ ((n >> 64) ^ (n >> 96))) & 0xFFFFFFFF
+
+def retry_request(url, error_log=None, *args, method='get', **kwargs):
     if error_log is None:
         error_log = sys.stderr
-    response = requests.get(url, *args, **kwargs)
+    response = _SESSION.request(method, url, *args, **kwargs)
+    for delay in (1, 10, 60):
+        if response.status_code != 429:
+            break
+        try:
+            delay = int(response.headers['Retry-After']) # prefer the wait time the server asked for
+        except (KeyError, ValueError):
+            pass
+        print('Rate limited, trying again in {} seconds'.format(delay), file=error_log)
+        time.sleep(delay)
+        response = _SESSION.request(method, url, *args, **kwargs)
     if response.status_code == 429:
-        print('Rate limited, trying again in a second', file=error_log)
-        time.sleep(1)
-        response = requests.get(url, *args, **kwargs)
-        if response.status_code == 429:
-            print('Still rate limited, trying again in 10 seconds', file=error_log)
-            time.sleep(10)
-            response = requests.get(url, *args, **kwargs)
-            if response.status_code == 429:
-                print('Still rate limited, trying again in a minute', file=error_log)
-                time.sleep(60)
-                response = requests.get(url, *args, **kwargs)
-                if response.status_code == 429:
-                    print('Still rate limited, giving up', file=error_log)
+        print('Still rate limited, giving up', file=error_log)
     response.raise_for_status()
     return response
 
@@ -122,7 +175,7 @@ def skin(player=None, *, profile_id=None, error_log=None):
         if isinstance(player, uuid.UUID):
             profile_id = player
         else:
-            response = requests.get('https://api.mojang.com/users/profiles/minecraft/{}'.format(player))
+            response = _SESSION.get('https://api.mojang.com/users/profiles/minecraft/{}'.format(player))
             response.raise_for_status()
             try:
                 j = response.json()
@@ -130,18 +183,34 @@ def skin(player=None, *, profile_id=None, error_log=None):
                 print('Failed to decode response: {!r}'.format(response), file=error_log)
                 raise
             profile_id = uuid.UUID(j['id'])
-    response = retry_request('https://sessionserver.mojang.com/session/minecraft/profile/{}'.format(re.sub('-', '', str(profile_id))), error_log=error_log)
-    textures = json.loads(base64.b64decode(response.json()['properties'][0]['value'].encode('utf-8')).decode('utf-8'))['textures']
+    profile_cache = _CACHE_DIR / 'profiles' / '{}.json'.format(profile_id)
+    textures = None
+    try:
+        if time.time() - profile_cache.stat().st_mtime < _PROFILE_CACHE_TTL:
+            with profile_cache.open() as cache_file:
+                textures = json.load(cache_file)
+    except (OSError, ValueError):
+        pass # missing or corrupted cache entry, fetch the profile again
+    if textures is None:
+        response = retry_request('https://sessionserver.mojang.com/session/minecraft/profile/{}'.format(profile_id.hex), error_log=error_log)
+        textures = json.loads(base64.b64decode(response.json()['properties'][0]['value'].encode('utf-8')).decode('utf-8'))['textures']
+        _write_cache(profile_cache, json.dumps(textures).encode('utf-8'))
     if 'SKIN' not in textures:
         # default skin
         profile_hash = java_uuid_hash_code(profile_id)
         if profile_hash % 2 == 0:
-            return Image.open('/opt/git/github.com/wurstmineberg/playerhead/master/steve.png'), 'steve'
+            return _default_skin('steve'), 'steve'
         else:
-            return Image.open('/opt/git/github.com/wurstmineberg/playerhead/master/alex.png'), 'alex'
-    response = requests.get(textures['SKIN']['url'], stream=True)
-    response.raise_for_status()
-    return Image.open(response.raw).convert('RGBA'), 'alex' if textures['SKIN'].get('metadata', {}).get('model') == 'slim' else 'steve'
+            return _default_skin('alex'), 'alex'
+    # skin textures are content-addressed, so the last path component of the URL works as a cache key
+    skin_cache = _CACHE_DIR / '{}.png'.format(textures['SKIN']['url'].rstrip('/').split('/')[-1])
+    if not skin_cache.exists():
+        response = _SESSION.get(textures['SKIN']['url'], stream=True)
+        response.raise_for_status()
+        response.raw.decode_content = True # undo any transfer encoding before the bytes hit the cache
+        _write_cache(skin_cache, response.raw)
+        response.close()
+    return Image.open(str(skin_cache)).convert('RGBA'), 'alex' if textures['SKIN'].get('metadata', {}).get('model') == 'slim' else 'steve'
 
 def write_head(player, *, target_dir=None, width=None, height=None, filename=None, error_log=None, profile_id=None, hat=True, full_body=False):
     try:
@@ -154,28 +223,31 @@ def write_head(player, *, target_dir=None, width=None, height=None, filename=Non
         if not check_nick(player):
             print('Invalid player name: ' + player, file=error_log)
             return False
-        if not target_dir.exists():
-            target_dir.mkdir(parents=True)
+        target_dir.mkdir(parents=True, exist_ok=True)
         if full_body:
-            function = body
             if width is None:
                 width = 16
             if height is None:
                 height = width * 2
+            result = body(player, hat=hat, profile_id=profile_id, error_log=error_log).resize((width, height), Image.NEAREST)
         else:
-            function = head
             if width is None:
                 width = 8
             if height is None:
                 height = width
-        function(player, hat=hat, profile_id=profile_id, error_log=error_log).resize((width, height)).save(str(target_dir / ((player if filename is None else filename) + '.png')))
+            result = head(player, hat=hat, profile_id=profile_id, error_log=error_log, size=(width, height))
+        result.save(target_dir / ((player if filename is None else filename) + '.png'))
     except Exception:
+        import traceback
+
         print('Error writing head for {}'.format(player), file=error_log)
         traceback.print_exc(file=error_log)
         return False
     return True
 
 if __name__ == '__main__':
+    from docopt import docopt
+
     arguments = docopt(__doc__, version='playerhead ' + __version__)
     kwargs = {
         'full_body': arguments['--full-body'],
@@ -192,33 +264,56 @@ if __name__ == '__main__':
         if arguments['--quiet']:
             kwargs['error_log'] = dev_null
         if arguments['--from-people-file']:
+            import concurrent.futures
             import people
 
-            for wmb_id, person in people.get_people_db().obj_dump(version=3)['people'].items():
+            people_dict = people.get_people_db().obj_dump(version=3)['people']
+            # resolve profile ids for everyone not already in the people file, 10 names per API call
+            unresolved = [person['minecraft']['nicks'][-1] for person in people_dict.values() if len(person.get('minecraft', {}).get('nicks', [])) > 0 and 'uuid' not in person['minecraft']]
+            try:
+                profile_ids = bulk_resolve(unresolved, error_log=kwargs.get('error_log'))
+            except requests.HTTPError:
+                print('Failed to resolve profile ids in bulk, falling back to per-player lookups', file=kwargs.get('error_log') or sys.stderr)
+                profile_ids = {}
+
+            def process_person(wmb_id, person):
                 if len(person.get('minecraft', {}).get('nicks', [])) > 0:
+                    person_kwargs = kwargs.copy()
                     if arguments['--use-person-id']:
-                        kwargs['filename'] = wmb_id
+                        person_kwargs['filename'] = wmb_id
                     if 'uuid' in person['minecraft']:
-                        kwargs['profile_id'] = uuid.UUID(person['minecraft']['uuid'])
-                    elif 'profile_id' in kwargs:
-                        del kwargs['profile_id']
-                    if not write_head(person['minecraft']['nicks'][-1], **kwargs):
-                        sys.exit(1)
+                        person_kwargs['profile_id'] = uuid.UUID(person['minecraft']['uuid'])
+                    else:
+                        person_kwargs['profile_id'] = profile_ids.get(person['minecraft']['nicks'][-1].lower())
+                    return write_head(person['minecraft']['nicks'][-1], **person_kwargs)
                 else:
                     print('No Minecraft nickname specified for person with id ' + person['id'], file=sys.stderr)
+                    return True
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor: # cap workers to stay below Mojang's rate limit
+                futures = [executor.submit(process_person, wmb_id, person) for wmb_id, person in people_dict.items()]
+                if not all([future.result() for future in futures]):
+                    sys.exit(1)
         elif arguments['--whitelist']:
-            with open(WHITELIST) as whitelist:
+            with open(arguments['--whitelist-file']) as whitelist:
                 try:
                     whitelist_json = json.load(whitelist)
                 except ValueError:
                     # old plaintext whitelist
-                    for line in whitelist:
-                        if not write_head(line.strip(), **kwargs):
+                    whitelist.seek(0)
+                    players = [line.strip() for line in whitelist if line.strip()]
+                    try:
+                        profile_ids = bulk_resolve(players, error_log=kwargs.get('error_log'))
+                    except requests.HTTPError:
+                        print('Failed to resolve profile ids in bulk, falling back to per-player lookups', file=kwargs.get('error_log') or sys.stderr)
+                        profile_ids = {}
+                    for player in players:
+                        if not write_head(player, profile_id=profile_ids.get(player.lower()), **kwargs):
                             sys.exit(1)
                 else:
                     # JSON whitelist
                     for player in whitelist_json:
-                        if not white_head(player['name'], profile_id=uuid.UUID(player['uuid']), **kwargs):
+                        if not write_head(player['name'], profile_id=uuid.UUID(player['uuid']), **kwargs):
                             sys.exit(1)
         elif arguments['<player>'] is None:
             prompt = 'playerhead> ' if sys.stdin.isatty else ''
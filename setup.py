@@ -10,8 +10,9 @@ setuptools.setup(
     py_modules=['playerhead'],
     package_data={'playerhead': ['alex.png', 'steve.png']},
     install_requires=[
-        'Pillow',
+        'Pillow-SIMD',
         'docopt',
+        'numpy',
         'people',
         'requests'
     ],